@@ -15,12 +15,21 @@ file for more details.
 
 Version:    2018.11.24 (beta)
             2018.12.04 fix the reconnect process if the device is not connected
+            2026.10.19 add a low overhead trace of bluetooth operations, dumped to the log on error or slow operation
+            2026.10.19 add a command line / batch driver (run "python3 MiPowPlayBulbAPI.py --help")
 
 """
 
 
 from bluepy import btle
 from datetime import datetime, timedelta
+import argparse
+import json
+import os
+import queue
+import re
+import sys
+import threading
 import time
 
 # if we are running as a plugin embedded in Domoticz then we need to overwrite python's logging module with Domoticz's
@@ -43,6 +52,13 @@ else:
     domoticz = True
 
 
+def _debugging():
+    # lets callers skip formatting debug messages that would not be logged anyway
+    if domoticz:
+        return bool(logging.debugging)
+    return logging.getLogger().isEnabledFor(logging.DEBUG)
+
+
 
 _MANUFACTURER = "Mipow Limited"
 
@@ -68,6 +84,58 @@ class Delegate(btle.DefaultDelegate):
         btle.DefaultDelegate.__init__(self)
 
 
+# trace outcomes that do not trigger a dump ("not connected" always follows a failed connect, which has dumped already)
+_TRACE_QUIET = ("ok", "retry", "not connected")
+
+
+class Tracer:
+    """Fixed size ring buffer of bluetooth operations (op, handle, bytes, duration, outcome).
+
+    Slots are preallocated so that recording an event only stores a few values. Nothing is formatted or
+    logged unless an operation fails or is slow, in which case the events recorded since the last dump are
+    written to the log (oldest first).
+    """
+
+    def __init__(self, size=32, slow=0.5):
+        self.size = size
+        self.slow = slow  # seconds above which an operation is considered slow
+        self.stamps = [0.0] * size
+        self.ops = [""] * size
+        self.handles = [None] * size
+        self.nbytes = [0] * size
+        self.durations = [0.0] * size
+        self.outcomes = [""] * size
+        self.index = 0     # next slot to be written
+        self.pending = 0   # number of events recorded since last dump
+
+    def record(self, op, handle, nbytes, duration, outcome, slow=None):
+        i = self.index
+        self.stamps[i] = time.time()
+        self.ops[i] = op
+        self.handles[i] = handle
+        self.nbytes[i] = nbytes
+        self.durations[i] = duration
+        self.outcomes[i] = outcome
+        self.index = (i + 1) % self.size
+        if self.pending < self.size:
+            self.pending += 1
+        if outcome not in _TRACE_QUIET:
+            self.dump(logging.error, "error in '{}'".format(op))
+        elif duration > (self.slow if slow is None else slow):
+            self.dump(logging.info, "slow '{}' ({:.3f}s)".format(op, duration))
+
+    def dump(self, log, reason):
+        log("MiPowPlayBulbAPI trace dump: {}, last {} operation(s):".format(reason, self.pending))
+        i = (self.index - self.pending) % self.size
+        for _ in range(self.pending):
+            log("    {} {} handle={} bytes={} duration={:.3f}s outcome={}".format(
+                datetime.fromtimestamp(self.stamps[i]).strftime("%H:%M:%S.%f")[:-3], self.ops[i],
+                hex(self.handles[i]) if self.handles[i] is not None else None, self.nbytes[i],
+                self.durations[i], self.outcomes[i]))
+            i = (i + 1) % self.size
+        self.pending = 0
+
+
 class MiPowLamp:
 
     def __init__(self, interface, mac, debug):
@@ -96,13 +164,15 @@ class MiPowLamp:
         self.speed = 0
         self.errmsg = ""
         self.strict_check = True
+        self.tracer = Tracer()
 
 
     def connect(self):
         self.errmsg = ""
+        connect_start = time.perf_counter()
         timeout_time = datetime.now() + timedelta(seconds=self.timeout)
         while datetime.now() < timeout_time:
-            logging.debug("I am in the connect loop")
+            start = time.perf_counter()
             try:
                 self.device = btle.Peripheral(self.mac, addrType=btle.ADDR_TYPE_PUBLIC, iface=self.interface)
                 self.connected = True
@@ -123,43 +193,57 @@ class MiPowLamp:
                     elif hook == "fffb":
                         self.handleWRGBES = handle
                 if self.manufacturer != _MANUFACTURER or (self.strict_check and not self.serial in _SERIAL):
-                    logging.error("Device found is not supported: Manufacturer = '{}', Serial = '{}' !".format(
-                        self.name, self.manufacturer, self.serial))
+                    self.errmsg = "Device found is not supported: Manufacturer = '{}', Serial = '{}' !".format(
+                        self.name, self.manufacturer, self.serial)
+                    logging.error(self.errmsg)
+                    self.tracer.record("connect", None, 0, time.perf_counter() - start, "unsupported")
                 else:
                     logging.info("Connected to device: Name = '{}', Manufacturer = '{}', Serial = '{}'".format(
                         self.name, self.manufacturer, self.serial))
                     logging.info("Bluetooth Color Handle = {}".format(hex(self.handleWRGB)))
                     logging.info("Bluetooth Effects Handle = {}".format(hex(self.handleWRGBES)))
+                    self.tracer.record("connect", None, 0, time.perf_counter() - start, "ok", slow=self.timeout)
                     self.get_state()
                 return True
             except btle.BTLEException as error:
                 self.connected = False
                 self.errmsg = "MiPowPlayBulbAPI connection error: {}".format(error)
-                logging.error(self.errmsg)
+                if _debugging():
+                    logging.debug(self.errmsg)
+                self.tracer.record("connect", None, 0, time.perf_counter() - start, "retry", slow=self.timeout)
                 time.sleep(0.1)  # sleep a little bit before trying to reconnect
+        # the retries are in the trace, so only the last error is logged
+        if self.errmsg:
+            logging.error(self.errmsg)
+        self.tracer.record("connect", None, 0, time.perf_counter() - connect_start, "timeout")
         return False
 
 
     def disconnect(self):
-        logging.debug("Disconnecting device '{}'".format(self.name))
+        if _debugging():
+            logging.debug("Disconnecting device '{}'".format(self.name))
         self.connected = False
         self.device.disconnect()
 
 
-    def _send_packet(self, handleId, data):
+    def _send_packet(self, handleId, data, op="write"):
         if not self.connected:
             self.connected = self.connect()
         if self.connected:
             self.errmsg = ""
+            start = time.perf_counter()
             try:
                 self.device.writeCharacteristic(handleId, data)
+                self.tracer.record(op, handleId, len(data), time.perf_counter() - start, "ok")
                 return True
             except btle.BTLEException as error:
                 self.connected = False
                 self.errmsg = "MiPowPlayBulbAPI packet send error: {}".format(error)
                 logging.error(self.errmsg)
+                self.tracer.record(op, handleId, len(data), time.perf_counter() - start, "error")
         else:
             self.errmsg = "MiPowPlayBulbAPI : device not connected, could not send packet"
+            self.tracer.record(op, handleId, len(data), 0.0, "not connected")
         return False
 
 
@@ -170,7 +254,7 @@ class MiPowLamp:
         self.green = 0
         self.blue = 0
         packet = bytearray([0x00, 0x00, 0x00, 0x00])
-        return self._send_packet(self.handleWRGB, packet)
+        return self._send_packet(self.handleWRGB, packet, "off")
 
 
     def set_white(self, level):
@@ -180,7 +264,7 @@ class MiPowLamp:
         self.green = 0
         self.blue = 0
         packet = bytearray([self.white, self.red, self.green, self.blue])
-        return self._send_packet(self.handleWRGB, packet)
+        return self._send_packet(self.handleWRGB, packet, "set_white")
 
 
     def set_rgb(self, red, green, blue):
@@ -189,7 +273,7 @@ class MiPowLamp:
         self.green = green
         self.blue = blue
         packet = bytearray([self.white, self.red, self.green, self.blue])
-        return self._send_packet(self.handleWRGB, packet)
+        return self._send_packet(self.handleWRGB, packet, "set_rgb")
 
 
     def set_rgbw(self, red, green, blue, white):
@@ -197,21 +281,20 @@ class MiPowLamp:
         self.red = red
         self.green = green
         self.blue = blue
-        logging.info("function set_rgb: red={}, green={}, blue={}, white={}".format(red, green, blue, white))
         packet = bytearray([self.white, self.red, self.green, self.blue])
-        return self._send_packet(self.handleWRGB, packet)
+        return self._send_packet(self.handleWRGB, packet, "set_rgbw")
 
 
     def set_effect(self, effect):
         self.effect = effect
         packet = bytearray([self.white, self.red, self.green, self.blue, self.effect, 0x00, self.speed, self.speed])
-        return self._send_packet(self.handleWRGBES, packet)
+        return self._send_packet(self.handleWRGBES, packet, "set_effect")
 
 
     def set_speed(self, speed):
         self.speed = speed
         packet = bytearray([self.white, self.red, self.green, self.blue, self.effect, 0x00, self.speed, self.speed])
-        return self._send_packet(self.handleWRGBES, packet)
+        return self._send_packet(self.handleWRGBES, packet, "set_speed")
 
 
     def get_state(self):
@@ -219,8 +302,10 @@ class MiPowLamp:
             self.connected = self.connect()
         if self.connected:
             self.errmsg = ""
+            start = time.perf_counter()
             try:
                 status = self.device.readCharacteristic(self.handleWRGB)
+                nbytes = len(status)
                 if bytearray(status) != bytearray([0, 0, 0, 0]):
                     self.power = True
                 else:
@@ -232,15 +317,209 @@ class MiPowLamp:
                 # get effect and speed
                 # note that handleWRGBES also provides actual real-time color data based on current effect and speed
                 status = self.device.readCharacteristic(self.handleWRGBES)
+                nbytes += len(status)
                 self.effect = status[4]
                 self.speed = status[6]
                 # let's update the battery level
-                self.battery = int.from_bytes(self.device.readCharacteristic(self.handlebattery), byteorder='big')
+                status = self.device.readCharacteristic(self.handlebattery)
+                nbytes += len(status)
+                self.battery = int.from_bytes(status, byteorder='big')
+                self.tracer.record("get_state", self.handleWRGB, nbytes, time.perf_counter() - start, "ok")
                 return True
             except btle.BTLEException as error:
                 self.connected = False
                 self.errmsg = "MiPowPlayBulbAPI status read error: {}".format(error)
                 logging.error(self.errmsg)
+                self.tracer.record("get_state", self.handleWRGB, 0, time.perf_counter() - start, "error")
         else:
             self.errmsg = "MiPowPlayBulbAPI : device not connected, could not read status"
+            self.tracer.record("get_state", self.handleWRGB, 0, 0.0, "not connected")
         return False
+
+
+# command line / batch driver: op -> (MiPowLamp method, number of arguments)
+_COMMANDS = {
+    "connect": ("connect", 0),
+    "disconnect": ("disconnect", 0),
+    "off": ("off", 0),
+    "white": ("set_white", 1),
+    "rgb": ("set_rgb", 3),
+    "rgbw": ("set_rgbw", 4),
+    "effect": ("set_effect", 1),
+    "speed": ("set_speed", 1),
+    "state": ("get_state", 0)}
+
+_MAC = re.compile(r"^([0-9A-F]{2}:){5}[0-9A-F]{2}$")
+
+
+def _parse_command(line):
+    """Parse a "MAC op [args...]" line into (mac, op, args), raising ValueError if invalid"""
+    parts = line.split()
+    if len(parts) < 2:
+        raise ValueError("expected 'MAC op [args...]'")
+    mac, op, args = parts[0].upper(), parts[1].lower(), parts[2:]
+    if not _MAC.match(mac):
+        raise ValueError("invalid MAC address '{}'".format(parts[0]))
+    if op not in _COMMANDS:
+        raise ValueError("unknown op '{}'".format(op))
+    if len(args) != _COMMANDS[op][1]:
+        raise ValueError("op '{}' takes {} argument(s)".format(op, _COMMANDS[op][1]))
+    args = [int(arg) for arg in args]
+    for arg in args:
+        if not 0 <= arg <= 255:
+            raise ValueError("argument {} out of range 0-255".format(arg))
+    return mac, op, args
+
+
+def _lamp_worker(lamp, tasks, emit, stop):
+    # commands for one lamp run in order on its own thread, so several lamps are driven in parallel
+    # and each keeps its bluetooth connection open between commands.
+    # Once stop is set, pending commands are skipped until the None sentinel
+    while True:
+        task = tasks.get(block=True)
+        if task is None:
+            if lamp.connected:
+                try:
+                    lamp.disconnect()
+                except Exception as err:
+                    logging.error("MiPowPlayBulbAPI disconnect error: {}".format(err))
+            break
+        if stop.is_set():
+            continue
+        lineno, op, args, queued = task
+        start = time.perf_counter()
+        result = {"line": lineno, "mac": lamp.mac, "op": op, "args": args}
+        try:
+            if op == "disconnect":
+                if lamp.connected:
+                    lamp.disconnect()
+                ok = True
+            elif not lamp.connected:
+                # connect() finds the bluetooth handles and already reads the lamp state, so there is no need to
+                # run "connect" or "state" again once connected
+                ok = lamp.connect()
+                if ok and op in ("connect", "state"):
+                    # connect() returns True even if the device is unsupported or the state read failed
+                    ok = lamp.connected and not lamp.errmsg
+                elif ok:
+                    ok = getattr(lamp, _COMMANDS[op][0])(*args)
+            elif op == "connect":
+                ok = True  # already connected: keep using the current connection
+            else:
+                ok = getattr(lamp, _COMMANDS[op][0])(*args)
+            error = lamp.errmsg
+        except Exception as err:
+            ok = False
+            error = "{}: {}".format(type(err).__name__, err)
+        result["ok"] = ok
+        if not ok:
+            result["error"] = error
+        if op in ("connect", "state") and ok:
+            result["state"] = {"power": lamp.power, "white": lamp.white, "red": lamp.red, "green": lamp.green,
+                               "blue": lamp.blue, "effect": lamp.effect, "speed": lamp.speed,
+                               "battery": lamp.battery}
+        result["wait"] = round(start - queued, 6)
+        result["duration"] = round(time.perf_counter() - start, 6)
+        emit(result)
+
+
+def run_batch(stream, out, interface=0, timeout=2, strict_check=True, queue_size=16):
+    """Run newline delimited "MAC op [args...]" commands from stream, writing one JSON result line per
+    command to out. Reading blocks once queue_size commands are pending for a lamp.
+    Returns the number of failed commands"""
+    lock = threading.Lock()
+    stop = threading.Event()
+    failed = [0]
+    write_error = []
+
+    def emit(result):
+        with lock:
+            if not result["ok"]:
+                failed[0] += 1
+            if write_error:
+                return
+            try:
+                out.write(json.dumps(result) + "\n")
+                out.flush()
+            except OSError as err:  # e.g. output piped into "head"
+                write_error.append(err)
+                stop.set()
+
+    def put(tasks, thread, task):
+        # never block forever on a full queue: give up if the worker has gone
+        while thread.is_alive():
+            try:
+                tasks.put(task, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    lamps = {}
+    try:
+        for lineno, line in enumerate(stream, 1):
+            if stop.is_set():
+                break
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                mac, op, args = _parse_command(line)
+            except ValueError as err:
+                emit({"line": lineno, "ok": False, "error": "invalid command: {}".format(err)})
+                continue
+            if mac not in lamps:
+                lamp = MiPowLamp(interface, mac, 0)
+                lamp.timeout = timeout
+                lamp.strict_check = strict_check
+                tasks = queue.Queue(maxsize=queue_size)
+                thread = threading.Thread(name=mac, target=_lamp_worker, args=(lamp, tasks, emit, stop))
+                thread.start()
+                lamps[mac] = (tasks, thread)
+            put(lamps[mac][0], lamps[mac][1], (lineno, op, args, time.perf_counter()))
+    except BaseException:
+        stop.set()  # interrupted or failed: skip the pending commands, only disconnect
+        raise
+    finally:
+        # always stop the workers, even if reading the input failed or was interrupted
+        for tasks, thread in lamps.values():
+            put(tasks, thread, None)
+        for tasks, thread in lamps.values():
+            thread.join()
+    if write_error:
+        raise write_error[0]
+    return failed[0]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Drive MiPow PlayBulb lamps from newline delimited commands 'MAC op [args...]', "
+                    "printing one JSON result per command. Ops: {}".format(", ".join(sorted(_COMMANDS))))
+    parser.add_argument("file", nargs="?", default="-", help="command file (default: stdin)")
+    parser.add_argument("-i", "--interface", type=int, default=0, help="bluetooth interface number (hciX)")
+    parser.add_argument("-t", "--timeout", type=float, default=2, help="connection timeout in seconds")
+    parser.add_argument("-q", "--queue-size", type=int, default=16,
+                        help="maximum number of pending commands per lamp before reading blocks")
+    parser.add_argument("--no-strict", action="store_true", help="do not check the lamp serial number")
+    parser.add_argument("-d", "--debug", action="store_true", help="log debugging messages to stderr")
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(stream=sys.stderr, level=logging.DEBUG if options.debug else logging.WARNING)
+    try:
+        if options.file == "-":
+            failed = run_batch(sys.stdin, sys.stdout, options.interface, options.timeout, not options.no_strict,
+                               options.queue_size)
+        else:
+            with open(options.file) as stream:
+                failed = run_batch(stream, sys.stdout, options.interface, options.timeout, not options.no_strict,
+                                   options.queue_size)
+    except BrokenPipeError:
+        # the reader of our output went away: silence the final flush of stdout and exit quietly
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())